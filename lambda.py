@@ -6,214 +6,1131 @@
 ## January 29 2020
 ##
 
+import re
+
+try:
+	# optional jit-compiled fast path for run mode
+	import numpy as np
+	from numba import njit
+	_HAVE_NUMBA = True
+except ImportError:
+	_HAVE_NUMBA = False
+
+
+# canonical term table for hash consing; keys use id() of children because
+# every child built through mk is already canonical
+_hashcons = {}
+
+# interned free variable names; bound variables are already ints
+_interned = {}
+
+# saved definitions, visible to the evaluators so run and step can
+# expand names lazily when reduction first reaches them
+saved = {}
+
+
+def intern(name):
+	# map a free variable name to a small stable int
+	num = _interned.get(name)
+	if num is None:
+		num = _interned[name] = len(_interned)
+	return num
+
+
 class Variable:
+	__slots__ = ('name', 'id', '_fv', '_maxidx', '_shash')
+
 	def __init__(self, name):
+		# bound variables hold their de bruijn index (int)
+		# free variables hold their name (str)
 		self.name = name
 
-	def unpack_saved(self, saved):
+		# the interned id: the index itself for bound variables, the
+		# complement of the interned name for free ones, so the two
+		# ranges can't collide and compares and hashes are plain ints
+		if isinstance(name, int):
+			self.id = name
+		else:
+			self.id = ~intern(name)
+
+		# memoized free variable info: the set of free names and the
+		# largest free index (-1 when the term is index closed)
+		if isinstance(name, int):
+			self._fv = frozenset()
+			self._maxidx = name
+		else:
+			self._fv = frozenset((self,))
+			self._maxidx = -1
+
+		# structural hash; indices make it independent of binder names
+		self._shash = hash(('V', self.id))
+
+	@classmethod
+	def mk(cls, name):
+		# return the canonical variable with this name
+		key = ('V', name if isinstance(name, int) else ~intern(name))
+		term = _hashcons.get(key)
+		if term is None:
+			term = _hashcons[key] = cls(name)
+		return term
+
+	def unpack_saved(self, saved, version):
 		# replace saved variables with their values
 		if self in saved:
 			return saved[self]
 		return self
 
-	def search(self, var):
-		# search for a free variable
-		return self == var
-
-	def substitute(self, find, replace):
-		# x[x := R] => R
-		if self == find:
-			return replace
-
-		# y[x := R] => y
-		return self
-
-	def step(self):
-		# running variables does nothing
-		return self, False
-
-	def is_eta_equiv(self, other, var_dict = {}):
-		# eta equivalent if variables correspond to each other
-		return isinstance(other, Variable) and (self == other or self in var_dict and var_dict[self] == other)
+	def is_eta_equiv(self, other):
+		return eta_equiv(self, other)
 
 	def __eq__(self, other):
-		return isinstance(other, Variable) and self.name == other.name
+		# hash consing makes equality identity
+		return self is other
 
 	def __hash__(self):
-		return hash(self.name)
+		# interning makes the hash a precomputed int
+		return self.id
 
 	def __repr__(self):
-		return '%s' % self.name
+		return show(self, [])
 
 
 class Application:
+	__slots__ = ('left', 'right', '_fv', '_maxidx', '_unpacked', '_str', '_shash')
+
 	def __init__(self, left, right):
 		self.left = left
 		self.right = right
+		self._fv = left._fv | right._fv
+		self._maxidx = max(left._maxidx, right._maxidx)
+		self._unpacked = None
+		self._str = None
+		self._shash = hash(('A', left._shash, right._shash))
+
+	@classmethod
+	def mk(cls, left, right):
+		# return the canonical application of these canonical children
+		key = ('A', id(left), id(right))
+		term = _hashcons.get(key)
+		if term is None:
+			term = _hashcons[key] = cls(left, right)
+		return term
+
+	def unpack_saved(self, saved, version):
+		# skip subtrees that mention no saved name
+		if self._fv.isdisjoint(saved):
+			return self
+
+		# reuse the expansion cached for the current saved table
+		if self._unpacked is not None and self._unpacked[0] == version:
+			return self._unpacked[1]
 
-	def unpack_saved(self, saved):
 		# replace saved variables with their values in child nodes
-		return Application(self.left.unpack_saved(saved), self.right.unpack_saved(saved))
+		term = Application.mk(self.left.unpack_saved(saved, version), self.right.unpack_saved(saved, version))
+		self._unpacked = (version, term)
+		return term
 
-	def search(self, var):
-		# search for a free variable
-		return self.left.search(var) or self.right.search(var)
+	def is_eta_equiv(self, other):
+		return eta_equiv(self, other)
 
-	def substitute(self, find, replace):
-		# (M N)[x := R] => (M[x := R] N[x := R])
-		return Application(self.left.substitute(find, replace), self.right.substitute(find, replace))
+	def __eq__(self, other):
+		# hash consing makes equality identity
+		return self is other
 
-	def step(self):
-		# we do one beta reduction at a time so that the step command makes sense
+	def __repr__(self):
+		return show(self, [])
 
-		# beta reduce functions
-		if isinstance(self.left, Function):
-			return self.left.body.substitute(self.left.arg, self.right), True
 
-		# run left node
-		left, changed = self.left.step()
-		if changed:
-			return Application(left, self.right), True
+class Function:
+	__slots__ = ('name', 'body', '_fv', '_maxidx', '_unpacked', '_str', '_shash')
 
-		# run right node
-		right, changed = self.right.step()
-		return Application(left, right), changed
+	def __init__(self, name, body):
+		# the body binds index 0; the name is only kept for pretty printing
+		self.name = name
+		self.body = body
+		self._fv = body._fv
+		# clamp so every closed term reads -1, since closedness tests
+		# compare against that one value
+		self._maxidx = max(body._maxidx - 1, -1)
+		self._unpacked = None
+		self._str = None
+
+		# the binder name is left out so the hash respects alpha equivalence
+		self._shash = hash(('L', body._shash))
+
+	@classmethod
+	def mk(cls, name, body):
+		# return the canonical function over this canonical body
+		# the name is part of the key so printing stays stable
+		key = ('L', name, id(body))
+		term = _hashcons.get(key)
+		if term is None:
+			term = _hashcons[key] = cls(name, body)
+		return term
+
+	def unpack_saved(self, saved, version):
+		# skip subtrees that mention no saved name
+		if self._fv.isdisjoint(saved):
+			return self
+
+		# reuse the expansion cached for the current saved table
+		if self._unpacked is not None and self._unpacked[0] == version:
+			return self._unpacked[1]
+
+		# replace saved variables with their values in the body
+		# saved values are closed, so no index can be captured
+		term = Function.mk(self.name, self.body.unpack_saved(saved, version))
+		self._unpacked = (version, term)
+		return term
 
-	def is_eta_equiv(self, other, var_dict = {}):
-		# eta equivalent if child nodes are eta equivalent
-		return isinstance(other, Application) \
-		   and self.left.is_eta_equiv(other.left, var_dict) and self.right.is_eta_equiv(other.right, var_dict)
+	def is_eta_equiv(self, other):
+		return eta_equiv(self, other)
 
 	def __eq__(self, other):
-		return isinstance(other, Application) and self.left == other.left and self.right == other.right
+		# hash consing makes equality identity
+		return self is other
 
 	def __repr__(self):
-		# figure out left parentheses
-		if isinstance(self.left, Function):
-			left = '(%s)' % self.left
+		return show(self, [])
+
+
+def eta_equiv(a, b):
+	# equivalence up to binder names, as an iterative pairwise walk so
+	# deep terms can't overflow the interpreter stack
+	# hash consing accepts shared subterms and mismatched structural
+	# hashes reject without walking, so little usually gets pushed
+	todo = [(a, b)]
+
+	while todo:
+		a, b = todo.pop()
+
+		if a is b:
+			continue
+		elif isinstance(a, Variable):
+			# indices make alpha equivalence structural
+			if not (isinstance(b, Variable) and a.id == b.id):
+				return False
+		elif isinstance(a, Application):
+			if not (isinstance(b, Application) and a._shash == b._shash):
+				return False
+			todo.append((a.right, b.right))
+			todo.append((a.left, b.left))
+		else:
+			# binder names don't matter, only the bodies do
+			if not (isinstance(b, Function) and a._shash == b._shash):
+				return False
+			todo.append((a.body, b.body))
+
+	return True
+
+
+# show work entry states
+SHOW_ENTER   = 0
+SHOW_EXIT    = 1
+SHOW_RESTORE = 2
+
+
+def show(term, binders):
+	# pretty print a term without recursing, so deep terms can't
+	# overflow the interpreter stack; string results land on out
+	# index-closed subterms print the same in any context, so their
+	# strings are rendered without the enclosing binders and cached on
+	# the (hash-consed, shared) node
+	todo = [(term, SHOW_ENTER, None)]
+	out = []
+	names = list(binders)
+
+	while todo:
+		node, state, name = todo.pop()
+
+		if state == SHOW_RESTORE:
+			# leaving a closed subterm; bring the outer binders back
+			names = name
+		elif state == SHOW_EXIT:
+			if isinstance(node, Application):
+				right = out.pop()
+				left = out.pop()
+
+				# figure out parentheses
+				if isinstance(node.left, Function):
+					left = '(%s)' % left
+				if not isinstance(node.right, Variable):
+					right = '(%s)' % right
+				text = '%s %s' % (left, right)
+			else:
+				body = out.pop()
+				names.pop()
+
+				if isinstance(node.body, Function):
+					# group arguments together
+					body = body.split('.')
+					args = body[0][1:]
+					text = 'λ%s %s.%s' % (name, args, '.'.join(body[1:]))
+				else:
+					text = 'λ%s.%s' % (name, body)
+
+			if node._maxidx == -1:
+				node._str = text
+			out.append(text)
+		elif isinstance(node, Variable):
+			# bound variables print the name of their binder
+			if not isinstance(node.name, int):
+				out.append(node.name)
+			elif node.name < len(names):
+				out.append(names[-1 - node.name])
+			else:
+				out.append('#%i' % node.name)
+		elif node._maxidx == -1 and node._str is not None:
+			out.append(node._str)
+		elif isinstance(node, Application):
+			if node._maxidx == -1 and names:
+				# render closed subterms context free so the cache is sound
+				todo.append((None, SHOW_RESTORE, names))
+				names = []
+
+			todo.append((node, SHOW_EXIT, None))
+			todo.append((node.right, SHOW_ENTER, None))
+			todo.append((node.left, SHOW_ENTER, None))
+		else:
+			if node._maxidx == -1 and names:
+				# render closed subterms context free so the cache is sound
+				todo.append((None, SHOW_RESTORE, names))
+				names = []
+
+			# pick a fresh name so shadowed binders stay readable
+			# free variables under the body count too, or the new name
+			# would capture them on a reparse
+			name = node.name
+			while name in names or Variable.mk(name) in node._fv:
+				name += "'"
+
+			names.append(name)
+			todo.append((node, SHOW_EXIT, name))
+			todo.append((node.body, SHOW_ENTER, None))
+
+	return out[0]
+
+
+def shift(term, d, cutoff = 0):
+	# shift free indices in term by d, with an explicit work stack
+	# terms with no free index at or above the cutoff shift to themselves
+	todo = [(term, cutoff, False)]
+	out = []
+
+	while todo:
+		node, cutoff, done = todo.pop()
+
+		if done:
+			if isinstance(node, Application):
+				right = out.pop()
+				left = out.pop()
+				if left is node.left and right is node.right:
+					out.append(node)
+				else:
+					out.append(Application.mk(left, right))
+			else:
+				body = out.pop()
+				if body is node.body:
+					out.append(node)
+				else:
+					out.append(Function.mk(node.name, body))
+		elif node._maxidx < cutoff:
+			out.append(node)
+		elif isinstance(node, Variable):
+			out.append(Variable.mk(node.name + d))
+		elif isinstance(node, Application):
+			todo.append((node, cutoff, True))
+			todo.append((node.right, cutoff, False))
+			todo.append((node.left, cutoff, False))
+		else:
+			todo.append((node, cutoff, True))
+			todo.append((node.body, cutoff + 1, False))
+
+	return out[0]
+
+
+def subst(term, j, s):
+	# substitute s for index j in term, with an explicit work stack
+	# terms where j isn't free are untouched
+	base = j
+	lifted = [s]
+	todo = [(term, j, False)]
+	out = []
+
+	while todo:
+		node, j, done = todo.pop()
+
+		if done:
+			if isinstance(node, Application):
+				right = out.pop()
+				left = out.pop()
+				if left is node.left and right is node.right:
+					out.append(node)
+				else:
+					out.append(Application.mk(left, right))
+			else:
+				body = out.pop()
+				if body is node.body:
+					out.append(node)
+				else:
+					out.append(Function.mk(node.name, body))
+		elif node._maxidx < j:
+			out.append(node)
+		elif isinstance(node, Variable):
+			if node.name == j:
+				# lift s by the number of binders crossed, lazily
+				while len(lifted) <= j - base:
+					lifted.append(shift(lifted[-1], 1))
+				out.append(lifted[j - base])
+			else:
+				out.append(node)
+		elif isinstance(node, Application):
+			todo.append((node, j, True))
+			todo.append((node.right, j, False))
+			todo.append((node.left, j, False))
 		else:
-			left = '%s' % self.left
+			todo.append((node, j, True))
+			todo.append((node.body, j + 1, False))
+
+	return out[0]
+
+
+def beta(func, arg):
+	# (λ.M) N => shift(M[0 := shift(N, 1)], -1)
+	# indices make this capture avoiding without any alpha conversion
+	return shift(subst(func.body, 0, shift(arg, 1)), -1)
+
+
+def parallel_step(term):
+	# one complete development: every redex present in the term is
+	# reduced in a single pass, and redexes the pass creates are left
+	# for the next one
+	todo = [(term, False)]
+	out = []
+	changed = False
+
+	while todo:
+		node, done = todo.pop()
+
+		if done:
+			if isinstance(node, Application):
+				right = out.pop()
+				left = out.pop()
+
+				# the redex check looks at the original child, so redexes
+				# formed by this very pass don't fire early
+				if isinstance(node.left, Function):
+					out.append(beta(left, right))
+					changed = True
+				elif left is node.left and right is node.right:
+					out.append(node)
+				else:
+					out.append(Application.mk(left, right))
+			else:
+				body = out.pop()
+				if body is node.body:
+					out.append(node)
+				else:
+					out.append(Function.mk(node.name, body))
+		elif isinstance(node, Variable):
+			out.append(node)
+		elif isinstance(node, Application):
+			todo.append((node, True))
+			todo.append((node.right, False))
+			todo.append((node.left, False))
+		else:
+			todo.append((node, True))
+			todo.append((node.body, False))
+
+	return out[0], changed
+
 
-		# figure out right parentheses
-		if isinstance(self.right, Variable):
-			right = '%s' % self.right
+def rebuild(todo, new):
+	# rebuild a step_once exploration path from a rewritten node back up
+	# to the root, reusing every untouched sibling
+	while todo:
+		node, state = todo.pop()
+		if not isinstance(node, Application):
+			new = Function.mk(node.name, new)
+		elif state == 1:
+			new = Application.mk(new, node.right)
 		else:
-			right = '(%s)' % self.right
+			new = Application.mk(node.left, new)
+	return new
+
+
+def step_once(term):
+	# one leftmost-outermost beta reduction, with an explicit work stack
+	# entries record which child of each node is being explored so the
+	# path to a found redex can be rebuilt
+	todo = [(term, 0)]
+
+	while todo:
+		node, state = todo.pop()
+
+		if isinstance(node, Application):
+			if state == 0:
+				if isinstance(node.left, Function):
+					# beta reduce and rebuild the path back to the root
+					return rebuild(todo, beta(node.left, node.right)), True
+
+				todo.append((node, 1))
+				todo.append((node.left, 0))
+			elif state == 1:
+				todo.append((node, 2))
+				todo.append((node.right, 0))
+		elif isinstance(node, Function):
+			if state == 0:
+				todo.append((node, 1))
+				todo.append((node.body, 0))
+		elif state == 0:
+			# expand a saved name where reduction first meets it
+			expanded = saved.get(node)
+			if expanded is not None and expanded is not node:
+				return rebuild(todo, expanded), True
+
+	return term, False
+
+
+def bind(term, name, depth = 0):
+	# turn free occurrences of name into the index pointing at the new binder
+	# occurrences bound by inner binders are already indices, so shadowing just works
+	if Variable.mk(name) not in term._fv:
+		return term
+
+	if isinstance(term, Variable):
+		if term.name == name:
+			return Variable.mk(depth)
+		return term
+	elif isinstance(term, Application):
+		return Application.mk(bind(term.left, name, depth), bind(term.right, name, depth))
+	else:
+		return Function.mk(term.name, bind(term.body, name, depth + 1))
 
-		# result
-		return '%s %s' % (left, right)
 
+# saved terms recognized as church numerals, keyed by id of the term
+# the hash cons table keeps the terms alive, so the ids are stable
+_church = {}
 
-class Function:
-	def __init__(self, arg, body):
-		self.arg = arg
-		self.body = body
 
-	def unpack_saved(self, saved):
-		# don't do anything if the arg is a saved variable
-		if self.arg in saved:
-			return self
+def detect_church(term):
+	# match the church numeral skeleton λs z.s (s (... z)), returning
+	# the numeral, or None if the term has any other shape
+	if not isinstance(term, Function) or not isinstance(term.body, Function):
+		return None
 
-		# replace saved variables with their values in the body
-		return Function(self.arg, self.body.unpack_saved(saved))
+	body = term.body.body
+	n = 0
+	while isinstance(body, Application):
+		left = body.left
+		if not isinstance(left, Variable) or left.name != 1:
+			return None
+		body = body.right
+		n += 1
 
-	def search(self, var):
-		# search for a free variable
-		return self.arg != var and self.body.search(var)
+	if isinstance(body, Variable) and body.name == 0:
+		return n
+	return None
 
-	def substitute(self, find, replace):
-		# (λx.M)[x := R] => λx.M
-		if self.arg == find:
-			return self
 
-		# if y is a free variable in R, then
-		# (λy.M)[x := R] => λy'.(M[y := y', x := R]) for some y' not a free variable in R
+def tag_church(term):
+	# remember saved church numerals so application can loop over their
+	# first argument natively instead of substituting down the chain
+	n = detect_church(term)
+	if n is not None:
+		_church[id(term)] = n
+	return term
+
+
+class OutOfFuel(Exception):
+	# raised when the machine hits the maximum iteration count
+	pass
+
+
+class Thunk:
+	__slots__ = ('term', 'env', 'value')
+
+	def __init__(self, term, env, value = None):
+		# a delayed evaluation; forcing stores the value so every
+		# use of a variable shares one evaluation (call by need)
+		self.term = term
+		self.env = env
+		self.value = value
+
+
+class Closure:
+	__slots__ = ('term', 'env')
+
+	def __init__(self, term, env):
+		# a Function term paired with the environment it was built in
+		self.term = term
+		self.env = env
+
+
+class Level:
+	__slots__ = ('depth',)
+
+	def __init__(self, depth):
+		# a fresh variable introduced while reducing under a binder,
+		# tracked as an absolute level and turned back into an index on readback
+		self.depth = depth
+
+
+class Neutral:
+	__slots__ = ('head', 'args')
+
+	def __init__(self, head, args):
+		# a free variable or level applied to a spine of thunks
+		self.head = head
+		self.args = args
+
 
-		# find a free variable in R
-		arg = self.arg
-		while replace.search(arg):
-			arg = Variable(arg.name + "'")
+class Compiled:
+	__slots__ = ('name', 'fn')
 
-		# alpha convert
-		if arg != self.arg:
-			body = self.body.substitute(self.arg, arg)
+	def __init__(self, name, fn):
+		# a function value compiled to a cpython closure
+		# the binder name is only kept for reading the value back
+		self.name = name
+		self.fn = fn
+
+
+# fuel cell shared with compiled code, since generated expressions
+# can't thread an argument through every application
+_compiled_fuel = [0]
+
+
+def _compiled_apply(func, arg):
+	# beta reduce a compiled value
+	if isinstance(func, Compiled):
+		if _compiled_fuel[0] <= 0:
+			raise OutOfFuel()
+		_compiled_fuel[0] -= 1
+		return func.fn(arg)
+
+	# neutral heads absorb their arguments
+	return Neutral(func.head, func.args + [arg])
+
+
+def _make_church(n, outer_name, inner_name):
+	# a church numeral as a native loop, so applying it costs n calls
+	# instead of n beta reductions through the successor chain
+	# the binder names come from the saved term so readback keeps them
+	def outer(s):
+		def inner(z):
+			for i in range(n):
+				z = _compiled_apply(s, z)
+			return z
+		return Compiled(inner_name, inner)
+	return Compiled(outer_name, outer)
+
+
+# compiled values of saved definitions, keyed by id of the stored term
+_compiled_saved = {}
+
+
+def _compiled_free(name):
+	# free variables evaluate to their saved value, or a neutral
+	var = Variable.mk(name)
+	term = saved.get(var)
+
+	if term is None or term is var:
+		return Neutral(var, [])
+
+	# expansion charges fuel so cyclic definition chains run out
+	# instead of recursing through compile_term forever
+	if _compiled_fuel[0] <= 0:
+		raise OutOfFuel()
+	_compiled_fuel[0] -= 1
+
+	value = _compiled_saved.get(id(term))
+	if value is None:
+		n = _church.get(id(term))
+		if n is not None:
+			value = _make_church(n, term.name, term.body.name)
 		else:
-			body = self.body
+			value = compile_term(term)
+		_compiled_saved[id(term)] = value
+	return value
 
-		# (λy.M)[x := R] => λy.(M[x := R])
-		return Function(arg, body.substitute(find, replace))
 
-	def step(self):
-		# run the body
-		body, changed = self.body.step()
-		return Function(self.arg, body), changed
+# the only names generated expressions may reference
+_codegen_env = {'M': Compiled, 'A': _compiled_apply, 'F': _compiled_free}
 
-	def is_eta_equiv(self, other, var_dict = {}):
-		# other must be a function to even be considered
-		if not isinstance(other, Function):
-			return False
 
-		# if the arguments are different, check equivalency with the args corresponding to each other
-		new_var_dict = var_dict
-		if self.arg != other.arg:
-			new_var_dict = var_dict.copy()
-			new_var_dict[self.arg] = other.arg
+def codegen(term, depth = 0):
+	# emit a python expression that evaluates the term, using cpython
+	# closures as environments: binders become lambdas, applications
+	# become calls, so the cpython vm does the dispatching
+	if isinstance(term, Variable):
+		if isinstance(term.name, int):
+			return 'v%i' % (depth - 1 - term.name)
+		return 'F(%r)' % term.name
+	elif isinstance(term, Application):
+		return 'A(%s, %s)' % (codegen(term.left, depth), codegen(term.right, depth))
+	else:
+		return 'M(%r, lambda v%i: %s)' % (term.name, depth, codegen(term.body, depth + 1))
 
-		# check equivalency of the body
-		return self.body.is_eta_equiv(other.body, new_var_dict)
 
-	def __eq__(self, other):
-		return isinstance(other, Function) and self.arg == other.arg and self.body == other.body
+def compile_term(term):
+	# compile and evaluate the generated expression to a machine value
+	return eval(compile(codegen(term), '<codegen>', 'eval'), _codegen_env)
+
+
+def force(thunk, fuel):
+	# evaluate a thunk once and remember the result
+	if thunk.value is None:
+		thunk.value = evaluate(thunk.term, thunk.env, fuel)
+		thunk.term = None
+		thunk.env = None
+	return thunk.value
 
-	def __repr__(self):
-		if isinstance(self.body, Function):
-			# group arguments together
-			body = ('%s' % self.body).split('.')
-			args = body[0][1:]
-			return 'λ%s %s.%s' % (self.arg, args, '.'.join(body[1:]))
 
-		# return result without any modifications
-		return 'λ%s.%s' % (self.arg, self.body)
+def apply_value(func, arg, fuel):
+	# apply a machine value to a thunk, outside the main machine loop
+	if isinstance(func, Closure):
+		if fuel[0] <= 0:
+			raise OutOfFuel()
+		fuel[0] -= 1
+		return evaluate(func.term.body, (arg, func.env), fuel)
+
+	# neutral heads absorb their arguments
+	return Neutral(func.head, func.args + [arg])
+
+
+def evaluate(term, env, fuel):
+	# krivine style machine: environments defer substitution entirely,
+	# so beta reduction never copies the function body
+	# env is a persistent list of (thunk, rest) pairs indexed by de bruijn index
+	stack = []
+
+	while True:
+		if isinstance(term, Application):
+			# push the argument and descend into the function
+			stack.append(Thunk(term.right, env))
+			term = term.left
+		elif isinstance(term, Function):
+			n = _church.get(id(term))
+			if n is not None and n > 0 and len(stack) >= 2:
+				# a saved church numeral with both arguments present
+				# iterates natively over its first argument
+				s = force(stack.pop(), fuel)
+				arg = stack.pop()
+				for i in range(n):
+					arg = Thunk(None, None, apply_value(s, arg, fuel))
+				value = arg.value
+
+				# neutral heads absorb the whole argument spine
+				if isinstance(value, Neutral) and stack:
+					value = Neutral(value.head, value.args + stack[::-1])
+					del stack[:]
+
+				if isinstance(value, Closure) and stack:
+					# keep reducing with the forced function
+					if fuel[0] <= 0:
+						raise OutOfFuel()
+					fuel[0] -= 1
+					env = (stack.pop(), value.env)
+					term = value.term.body
+				else:
+					return value
+			elif stack:
+				# beta reduce by extending the environment
+				if fuel[0] <= 0:
+					raise OutOfFuel()
+				fuel[0] -= 1
+				env = (stack.pop(), env)
+				term = term.body
+			else:
+				return Closure(term, env)
+		else:
+			# look the variable up
+			if isinstance(term.name, int):
+				looked_up = env
+				for i in range(term.name):
+					looked_up = looked_up[1]
+				value = force(looked_up[0], fuel)
+			else:
+				# expand saved names on first contact instead of in an
+				# eager unpack_saved pass over the whole tree
+				# expansion charges fuel so cyclic definition chains hit
+				# the iteration limit instead of spinning forever
+				expanded = saved.get(term)
+				if expanded is not None and expanded is not term:
+					if fuel[0] <= 0:
+						raise OutOfFuel()
+					fuel[0] -= 1
+					term = expanded
+					continue
+				value = Neutral(term, [])
+
+			# neutral heads absorb the whole argument spine
+			if isinstance(value, Neutral) and stack:
+				value = Neutral(value.head, value.args + stack[::-1])
+				del stack[:]
+
+			if isinstance(value, Closure) and stack:
+				# keep reducing with the forced function
+				if fuel[0] <= 0:
+					raise OutOfFuel()
+				fuel[0] -= 1
+				env = (stack.pop(), value.env)
+				term = value.term.body
+			else:
+				return value
+
+
+def quote(value, depth, fuel):
+	# read a machine value back into a term in normal form, with an
+	# explicit work stack so big normal forms can't overflow
+	todo = [(value, depth, False)]
+	out = []
+
+	while todo:
+		value, depth, done = todo.pop()
+
+		if done:
+			if isinstance(value, Closure):
+				out.append(Function.mk(value.term.name, out.pop()))
+			elif isinstance(value, Compiled):
+				out.append(Function.mk(value.name, out.pop()))
+			else:
+				# rebuild the neutral application spine
+				if isinstance(value.head, Level):
+					# convert the level back into an index
+					term = Variable.mk(depth - 1 - value.head.depth)
+				else:
+					term = value.head
+
+				for arg in out[len(out) - len(value.args):]:
+					term = Application.mk(term, arg)
+				del out[len(out) - len(value.args):]
+				out.append(term)
+		elif isinstance(value, Closure):
+			# reduce under the binder with a fresh level
+			fresh = Thunk(None, None, Neutral(Level(depth), []))
+			body = evaluate(value.term.body, (fresh, value.env), fuel)
+			todo.append((value, depth, True))
+			todo.append((body, depth + 1, False))
+		elif isinstance(value, Compiled):
+			# reduce under the binder with a fresh level
+			body = _compiled_apply(value, Neutral(Level(depth), []))
+			todo.append((value, depth, True))
+			todo.append((body, depth + 1, False))
+		else:
+			# compiled spines hold values directly, machine spines hold thunks
+			todo.append((value, depth, True))
+			for arg in value.args[::-1]:
+				if isinstance(arg, Thunk):
+					arg = force(arg, fuel)
+				todo.append((arg, depth, False))
+
+	return out[0]
+
+
+def normalize(term, max_iters):
+	# evaluate to normal form, giving up after max_iters beta reductions
+
+	# try the compiled path first; it leans on the cpython stack, so deep
+	# terms fall back to the iterative environment machine below
+	# it is also call by value, so running out of fuel there proves
+	# nothing about normal order: retry on the machine before giving up
+	_compiled_fuel[0] = max_iters
+	try:
+		return quote(compile_term(term), 0, _compiled_fuel), max_iters - _compiled_fuel[0], False
+	except (OutOfFuel, RecursionError, MemoryError, SyntaxError):
+		# SyntaxError covers cpython's nesting limit on generated code
+		pass
+
+	fuel = [max_iters]
+	try:
+		term = quote(evaluate(term, None, fuel), 0, fuel)
+		return term, max_iters - fuel[0], False
+	except OutOfFuel:
+		return term, max_iters, True
+
+
+# arena node tags
+TAG_VAR = 0
+TAG_APP = 1
+TAG_LAM = 2
+
+
+def arena_encode(term, tags, aa, bb, names, name_ids):
+	# flatten a term into the arena lists, returning its node index
+	# explicit work stack so deep terms can't overflow the interpreter
+	todo = [(term, False)]
+	out = []
+
+	while todo:
+		node, done = todo.pop()
+
+		if isinstance(node, Variable):
+			if isinstance(node.name, int):
+				# bound variables keep their index in a
+				a = node.name
+			else:
+				# free variables are stored as negative name table entries,
+				# so they sit below every cutoff and shift/subst skip them
+				if node.name not in name_ids:
+					name_ids[node.name] = len(names)
+					names.append(node.name)
+				a = -1 - name_ids[node.name]
+			tags.append(TAG_VAR)
+			aa.append(a)
+			bb.append(0)
+			out.append(len(tags) - 1)
+		elif isinstance(node, Application):
+			if not done:
+				todo.append((node, True))
+				todo.append((node.right, False))
+				todo.append((node.left, False))
+			else:
+				right = out.pop()
+				left = out.pop()
+				tags.append(TAG_APP)
+				aa.append(left)
+				bb.append(right)
+				out.append(len(tags) - 1)
+		else:
+			if not done:
+				todo.append((node, True))
+				todo.append((node.body, False))
+			else:
+				body = out.pop()
+				if node.name not in name_ids:
+					name_ids[node.name] = len(names)
+					names.append(node.name)
+				tags.append(TAG_LAM)
+				aa.append(body)
+				bb.append(name_ids[node.name])
+				out.append(len(tags) - 1)
+
+	return out.pop()
+
+
+def arena_decode(tag, a, b, node, names):
+	# rebuild a term from its arena node, with an explicit work stack
+	todo = [(node, False)]
+	out = []
+
+	while todo:
+		node, done = todo.pop()
+
+		if tag[node] == TAG_VAR:
+			i = int(a[node])
+			if i >= 0:
+				out.append(Variable.mk(i))
+			else:
+				out.append(Variable.mk(names[-1 - i]))
+		elif tag[node] == TAG_APP:
+			if not done:
+				todo.append((node, True))
+				todo.append((int(b[node]), False))
+				todo.append((int(a[node]), False))
+			else:
+				right = out.pop()
+				left = out.pop()
+				out.append(Application.mk(left, right))
+		else:
+			if not done:
+				todo.append((node, True))
+				todo.append((int(a[node]), False))
+			else:
+				out.append(Function.mk(names[int(b[node])], out.pop()))
+
+	return out.pop()
+
+
+if _HAVE_NUMBA:
+	@njit(cache = True)
+	def _arena_new(tag, a, b, used, t, x, y):
+		# bump allocate a node; -1 signals the arena is full
+		if used >= tag.shape[0]:
+			return -1, used
+		tag[used] = t
+		a[used] = x
+		b[used] = y
+		return used, used + 1
+
+	@njit(cache = True)
+	def _arena_shift(tag, a, b, used, node, d, cutoff):
+		# shift free indices by d, sharing untouched subtrees
+		t = tag[node]
+		if t == TAG_VAR:
+			i = a[node]
+			if i >= cutoff:
+				return _arena_new(tag, a, b, used, TAG_VAR, i + d, 0)
+			return node, used
+		elif t == TAG_APP:
+			left, used = _arena_shift(tag, a, b, used, a[node], d, cutoff)
+			if left < 0:
+				return -1, used
+			right, used = _arena_shift(tag, a, b, used, b[node], d, cutoff)
+			if right < 0:
+				return -1, used
+			if left == a[node] and right == b[node]:
+				return node, used
+			return _arena_new(tag, a, b, used, TAG_APP, left, right)
+		else:
+			body, used = _arena_shift(tag, a, b, used, a[node], d, cutoff + 1)
+			if body < 0:
+				return -1, used
+			if body == a[node]:
+				return node, used
+			return _arena_new(tag, a, b, used, TAG_LAM, body, b[node])
+
+	@njit(cache = True)
+	def _arena_subst(tag, a, b, used, node, j, s):
+		# substitute node s for index j
+		t = tag[node]
+		if t == TAG_VAR:
+			if a[node] == j:
+				return s, used
+			return node, used
+		elif t == TAG_APP:
+			left, used = _arena_subst(tag, a, b, used, a[node], j, s)
+			if left < 0:
+				return -1, used
+			right, used = _arena_subst(tag, a, b, used, b[node], j, s)
+			if right < 0:
+				return -1, used
+			if left == a[node] and right == b[node]:
+				return node, used
+			return _arena_new(tag, a, b, used, TAG_APP, left, right)
+		else:
+			lifted, used = _arena_shift(tag, a, b, used, s, 1, 0)
+			if lifted < 0:
+				return -1, used
+			body, used = _arena_subst(tag, a, b, used, a[node], j + 1, lifted)
+			if body < 0:
+				return -1, used
+			if body == a[node]:
+				return node, used
+			return _arena_new(tag, a, b, used, TAG_LAM, body, b[node])
+
+	@njit(cache = True)
+	def _arena_step(tag, a, b, used, node):
+		# one leftmost-outermost beta reduction, mirroring step()
+		t = tag[node]
+		if t == TAG_APP:
+			left = a[node]
+			right = b[node]
+
+			if tag[left] == TAG_LAM:
+				# beta reduce: shift(subst(body, 0, shift(arg, 1)), -1)
+				lifted, used = _arena_shift(tag, a, b, used, right, 1, 0)
+				if lifted < 0:
+					return -1, used, False
+				body, used = _arena_subst(tag, a, b, used, a[left], 0, lifted)
+				if body < 0:
+					return -1, used, False
+				node, used = _arena_shift(tag, a, b, used, body, -1, 0)
+				return node, used, True
+
+			new_left, used, changed = _arena_step(tag, a, b, used, left)
+			if new_left < 0:
+				return -1, used, False
+			if changed:
+				node, used = _arena_new(tag, a, b, used, TAG_APP, new_left, right)
+				return node, used, True
+
+			new_right, used, changed = _arena_step(tag, a, b, used, right)
+			if new_right < 0:
+				return -1, used, False
+			if changed:
+				node, used = _arena_new(tag, a, b, used, TAG_APP, left, new_right)
+				return node, used, True
+			return node, used, False
+		elif t == TAG_LAM:
+			body, used, changed = _arena_step(tag, a, b, used, a[node])
+			if body < 0:
+				return -1, used, False
+			if changed:
+				node, used = _arena_new(tag, a, b, used, TAG_LAM, body, b[node])
+				return node, used, True
+			return node, used, False
+		return node, used, False
+
+	@njit(cache = True)
+	def _arena_run(tag, a, b, used, root, fuel):
+		# reduce until normal form, out of fuel, or out of arena space
+		iters = 0
+		while iters < fuel:
+			iters += 1
+			node, used, changed = _arena_step(tag, a, b, used, root)
+			if node < 0:
+				# out of space; the caller compacts and resumes
+				return root, used, iters - 1, 1
+			root = node
+			if not changed:
+				return root, used, iters, 0
+		return root, used, iters, 2
+
+
+def arena_run(term, max_iters):
+	# run the jitted arena loop, growing the arena whenever it fills up
+	tags = []
+	aa = []
+	bb = []
+	names = []
+	arena_encode(term, tags, aa, bb, names, {})
+	root = len(tags) - 1
+	cap = max(1024, 8 * len(tags))
+	iters = 0
+
+	while True:
+		tag = np.zeros(cap, np.uint8)
+		a = np.zeros(cap, np.int32)
+		b = np.zeros(cap, np.int32)
+		tag[:len(tags)] = tags
+		a[:len(aa)] = aa
+		b[:len(bb)] = bb
+
+		root, used, n, status = _arena_run(tag, a, b, len(tags), root, max_iters - iters)
+		iters += n
+
+		if status == 1:
+			# compact the live term into a bigger arena and resume
+			term = arena_decode(tag, a, b, root, names)
+			tags = []
+			aa = []
+			bb = []
+			names = []
+			arena_encode(term, tags, aa, bb, names, {})
+			root = len(tags) - 1
+			cap = max(cap * 2, 8 * len(tags))
+			continue
+
+		# status 0 is normal form, status 2 is out of fuel
+		return arena_decode(tag, a, b, root, names), iters, status == 2
+
+
+# one token per match: a special character or a run of symbol characters,
+# with ; marking the start of a comment
+_token_regex = re.compile(r'[()\\.λ=]|[^\s()\\.λ=;]+|;')
 
 
 def lex(string):
-	token = ''
-
-	for c in string:
-		# yield special characters
-		if c in '().\\λ=':
-			if token != '':
-				yield token
-				token = ''
-			yield c
-		elif c in ' \t':
-			# skip whitespace
-			if token != '':
-				yield token
-				token = ''
-		elif c == ';':
+	# one C-level scan instead of a python loop per character
+	for match in _token_regex.finditer(string):
+		token = match.group()
+
+		if token == ';':
 			# stop after comments
-			if token != '':
-				yield token
 			return
-		else:
-			# grow symbol tokens
-			token += c
-
-	# yield the last token
-	if token != '':
 		yield token
 
 
 def build_application(stack, start_index):
-	built = None
+	if start_index >= len(stack):
+		return None
 
-	# build the application left to right
-	for expr in stack[start_index:]:
-		if built is None:
-			built = expr
-		else:
-			built = Application(built, expr)
+	# build the application left to right, indexing into the stack
+	# directly instead of copying the tail out with a slice
+	built = stack[start_index]
+	for i in range(start_index + 1, len(stack)):
+		built = Application.mk(built, stack[i])
 
 	# pop everything
 	del stack[start_index:]
@@ -231,7 +1148,10 @@ def apply_stack(stack):
 		if checking_lambda_args:
 			# between λ and . should be only variables
 			if isinstance(expr, Variable):
-				built = Function(stack.pop(), built)
+				arg = stack.pop()
+				if built is not None:
+					built = bind(built, arg.name)
+				built = Function.mk(arg.name, built)
 			elif expr == '\\' or expr == 'λ':
 				# if a function isn't built, then λ. happened
 				if not isinstance(built, Function):
@@ -273,6 +1193,7 @@ LAMBDA_MODE_RUN  = 0b0001
 LAMBDA_MODE_SET  = 0b0010
 LAMBDA_MODE_STEP = 0b0100
 LAMBDA_MODE_ERR  = 0b1000
+LAMBDA_MODE_PRUN = 0b10000
 
 
 def parse(string):
@@ -305,13 +1226,19 @@ def parse(string):
 				stack.append(built)
 		elif token == 'run':
 			# change the mode to run
-			if len(stack) == 0 and not (mode & LAMBDA_MODE_STEP):
+			if len(stack) == 0 and not (mode & (LAMBDA_MODE_STEP | LAMBDA_MODE_PRUN)):
 				mode |= LAMBDA_MODE_RUN
 			else:
 				return "Syntax error: unexpected 'run'", LAMBDA_MODE_ERR
+		elif token == 'prun':
+			# change the mode to parallel run
+			if len(stack) == 0 and not (mode & (LAMBDA_MODE_RUN | LAMBDA_MODE_STEP)):
+				mode |= LAMBDA_MODE_PRUN
+			else:
+				return "Syntax error: unexpected 'prun'", LAMBDA_MODE_ERR
 		elif token == 'step':
 			# change the mode to run
-			if len(stack) == 0 and not (mode & LAMBDA_MODE_RUN):
+			if len(stack) == 0 and not (mode & (LAMBDA_MODE_RUN | LAMBDA_MODE_PRUN)):
 				mode |= LAMBDA_MODE_STEP
 			else:
 				return "Syntax error: unexpected 'run'", LAMBDA_MODE_ERR
@@ -324,7 +1251,7 @@ def parse(string):
 				return "Syntax error: unexpected '='", LAMBDA_MODE_ERR
 		else:
 			# push symbols onto stack
-			var = Variable(token)
+			var = Variable.mk(token)
 			stack.append(var)
 
 	# apply everything in the stack
@@ -343,16 +1270,15 @@ def parse(string):
 			return "Syntax error: unexpected '='", LAMBDA_MODE_ERR
 		else:
 			# set
-			return Application(var_name, built), mode
+			return Application.mk(var_name, built), mode
 	else:
 		# expression or run
 		return built, mode
 
 if __name__ == '__main__':
-	import re
 	print('Lambda parser and applicator')
 	string = None
-	saved = {}
+	saved_version = 0
 	max_iters = 1000
 
 	while True:
@@ -398,15 +1324,18 @@ if __name__ == '__main__':
 				continue
 
 			# λs z.z is zero
-			body = Variable('z')
+			body = Variable.mk(0)
 			for i in range(0, end + 1):
 				if i >= start:
 					# add all the numbers in the specified range as variables
-					saved[Variable('%i' % i)] = Function(Variable('s'), Function(Variable('z'), body))
+					numeral = Function.mk('s', Function.mk('z', body))
+					_church[id(numeral)] = i
+					saved[Variable.mk('%i' % i)] = numeral
 
 				# successor function; ie, (λn.λs z.s (n s z)) i
-				body = Application(Variable('s'), body)
+				body = Application.mk(Variable.mk(1), body)
 
+			saved_version += 1
 			print('Populated numbers %i to %i' % (start, end))
 			continue
 
@@ -425,17 +1354,33 @@ if __name__ == '__main__':
 			print('%s is already defined' % tree.left)
 			continue
 
-		tree = tree.unpack_saved(saved)
+		if mode & LAMBDA_MODE_STEP or (mode & LAMBDA_MODE_RUN and not _HAVE_NUMBA):
+			# run and step fuse expansion into reduction: saved names are
+			# expanded lazily when first reached, so unreachable ones never
+			# get expanded at all
+			pass
+		elif mode & (LAMBDA_MODE_RUN | LAMBDA_MODE_PRUN):
+			# prun and the arena expand eagerly, so iterate to a fixed
+			# point: definitions bound before their names were defined
+			# then reduce the same as on the lazy engines
+			# cyclic chains stop at the iteration cap like any other loop
+			for i in range(max_iters):
+				expanded = tree.unpack_saved(saved, saved_version)
+				if expanded is tree:
+					break
+				tree = expanded
+		else:
+			tree = tree.unpack_saved(saved, saved_version)
 
-		if mode & (LAMBDA_MODE_RUN | LAMBDA_MODE_STEP):
+		if mode & (LAMBDA_MODE_RUN | LAMBDA_MODE_STEP | LAMBDA_MODE_PRUN):
 			# run or step
 			running = True
 			iter = 0
 
 			try:
-				while running and iter < max_iters:
-					if (mode & LAMBDA_MODE_STEP):
-						# step through execution one beta reduction at a time
+				if mode & LAMBDA_MODE_STEP:
+					# step through execution one beta reduction at a time
+					while running:
 						print(tree)
 						command = input('!!').strip()
 
@@ -443,19 +1388,35 @@ if __name__ == '__main__':
 						if command == 'exit' or command == 'quit':
 							raise StopIteration()
 						elif command == 'run' or command == 'continue':
+							# hand the rest of the reduction to the fast path,
+							# whose argument stack walks the spine once instead
+							# of rescanning from the root every beta reduction
 							mode ^= LAMBDA_MODE_STEP | LAMBDA_MODE_RUN
-					else:
-						# count number of iterations
-						iter += 1
+							break
+
+						# execute
+						tree, running = step_once(tree)
 
-					# execute
-					tree, running = tree.step()
+				if running and (mode & LAMBDA_MODE_PRUN):
+					# parallel beta: one whole-term development per iteration
+					while running and iter < max_iters:
+						iter += 1
+						tree, running = parallel_step(tree)
+				elif running and (mode & LAMBDA_MODE_RUN):
+					if _HAVE_NUMBA:
+						# hot loop runs jit compiled over the flat arena
+						# the jitted kernels still recurse over term depth,
+						# so very deep terms retry on the iterative engines
+						try:
+							tree, iter, running = arena_run(tree, max_iters)
+						except RecursionError:
+							tree, iter, running = normalize(tree, max_iters)
+					else:
+						# environment machine defers and shares substitutions
+						tree, iter, running = normalize(tree, max_iters)
 
-				if iter >= max_iters:
+				if running:
 					print('Warning: maximum iterations achieved (use setiter integer or step through execution)')
-			except RecursionError:
-				print('Error: maximum recursion depth exceeded (try increasing program memory)')
-				continue
 			except KeyboardInterrupt:
 				print('\nExecution halted')
 				continue
@@ -467,13 +1428,23 @@ if __name__ == '__main__':
 				continue
 
 		if mode & LAMBDA_MODE_SET:
+			# normalize the definition now so every later use plugs in an
+			# already reduced term instead of re-reducing it
+			value, _, running = normalize(tree.right, max_iters)
+			if running:
+				# divergent definitions (like Y) are stored as written
+				value = tree.right
+
 			# set
-			saved[tree.left] = tree.right
-			print('Added %s as %s' % (tree.right, tree.left))
+			saved[tree.left] = tag_church(value)
+			saved_version += 1
+			print('Added %s as %s' % (value, tree.left))
 		else:
 			# search for eta equivalent functions saved and print them out
+			# compare structural hashes first so the scan over saved is
+			# mostly integer compares
 			for key in saved:
-				if tree.is_eta_equiv(saved[key]):
+				if tree._shash == saved[key]._shash and tree.is_eta_equiv(saved[key]):
 					print(key)
 
 			# print the final expression